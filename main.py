@@ -9,9 +9,11 @@ from telegram.ext import (
     Dispatcher, CommandHandler, MessageHandler, Filters, CallbackContext,
     CallbackQueryHandler, JobQueue
 )
+from telegram.error import RetryAfter, BadRequest, Unauthorized
 
 from flask import Flask, request, jsonify
-import os, uuid, threading, time, hashlib, secrets, json
+import os, sys, uuid, threading, time, hashlib, secrets, json, random, functools
+import logging, logging.handlers
 
 # =========================
 # Storage & Config
@@ -24,15 +26,67 @@ DATA_DIR = "data"
 STATE_FILE = os.path.join(DATA_DIR, "bot_state.json")
 PERSIST_LOCK = threading.Lock()
 
+# ---- Concurrency ----
+# Lock order: user_lock -> token_lock -> STATE_LOCK. STATE_LOCK is held only briefly to
+# read/replace entries of shared_files/all_users/pending_groups, never while doing I/O.
+# shared_files entries are copy-on-write: never mutate one in place, publish a new dict
+# via update_entry() so snapshots taken for save_state() stay consistent.
+STATE_LOCK = threading.RLock()
+LOCK_STRIPES = 64
+_token_locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+_user_locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+
+def token_lock(token):
+    return _token_locks[hash(token) % LOCK_STRIPES]
+
+def user_lock(user_id):
+    return _user_locks[hash(user_id) % LOCK_STRIPES]
+
+def per_user_locked(handler):
+    """Serializes handler calls per user; different users still run in parallel."""
+    @functools.wraps(handler)
+    def wrapper(update: Update, context: CallbackContext):
+        user = update.effective_user
+        if user is None: return handler(update, context)
+        with user_lock(user.id):
+            return handler(update, context)
+    return wrapper
+
+def update_entry(token, **changes):
+    with STATE_LOCK:
+        entry = shared_files.get(token)
+        if entry is None: return None
+        entry = dict(entry, **changes)
+        shared_files[token] = entry
+        return entry
+
+def add_user(user_id):
+    with STATE_LOCK:
+        all_users.add(user_id)
+
+def entries_snapshot():
+    with STATE_LOCK:
+        return list(shared_files.items())
+
+def users_snapshot():
+    with STATE_LOCK:
+        return list(all_users)
+
+def snapshot_state():
+    with STATE_LOCK:
+        return {
+            "shared_files": dict(shared_files),
+            "all_users": list(all_users),
+            "delivery_outbox": dict(delivery_outbox),
+        }
+
 def save_state():
     try:
         os.makedirs(DATA_DIR, exist_ok=True)
-        data = {
-            "shared_files": shared_files,
-            "all_users": list(all_users),
-        }
         tmp = STATE_FILE + ".tmp"
         with PERSIST_LOCK:
+            # snapshot inside PERSIST_LOCK so an older snapshot never overwrites a newer one
+            data = snapshot_state()
             with open(tmp, "w", encoding="utf-8") as f:
                 json.dump(data, f, ensure_ascii=False)
                 f.flush(); os.fsync(f.fileno())
@@ -45,14 +99,140 @@ def load_state():
         if os.path.exists(STATE_FILE):
             with open(STATE_FILE, "r", encoding="utf-8") as f:
                 data = json.load(f)
-            shared_files.update(data.get("shared_files", {}))
-            all_users.update(set(data.get("all_users", [])))
+            with STATE_LOCK:
+                shared_files.update(data.get("shared_files", {}))
+                all_users.update(set(data.get("all_users", [])))
+                delivery_outbox.update(data.get("delivery_outbox", {}))
     except Exception:
         pass
 
+# ---- Update profiler (collapsed stacks for flame graphs) ----
+# PROFILE_SAMPLE_RATE: fraction of updates to profile (0 = off); also settable via /profile
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+PROFILE_FILE = os.path.join(PROFILE_DIR, "updates.folded")
+
+def env_int(name, default, minimum):
+    try:
+        return max(int(os.environ.get(name) or default), minimum)
+    except ValueError:
+        return default
+
+PROFILE_MAX_BYTES = env_int("PROFILE_MAX_BYTES", 5 * 1024 * 1024, 64 * 1024)
+PROFILE_BACKUPS = env_int("PROFILE_BACKUPS", 5, 1)
+
+def parse_sample_rate(value):
+    try:
+        rate = float(value or 0)
+    except ValueError:
+        return 0.0
+    if not rate >= 0: return 0.0  # negative or NaN
+    return min(rate, 1.0)
+
+profile_settings = {'rate': parse_sample_rate(os.environ.get("PROFILE_SAMPLE_RATE"))}
+_profile_logger = None
+
+def get_profile_logger():
+    global _profile_logger
+    if _profile_logger is None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            PROFILE_FILE, maxBytes=PROFILE_MAX_BYTES, backupCount=PROFILE_BACKUPS, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger = logging.getLogger("bot.profile")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(handler)
+        _profile_logger = logger
+    return _profile_logger
+
+def frame_label(frame):
+    module = frame.f_globals.get('__name__') or "?"
+    return f"{module}:{frame.f_code.co_name}"
+
+def c_func_label(fn):
+    module = getattr(fn, '__module__', None)
+    if module is None:
+        owner = getattr(fn, '__self__', None)
+        module = type(owner).__module__ if owner is not None else "builtins"
+    name = getattr(fn, '__qualname__', None) or getattr(fn, '__name__', "?")
+    return f"{module}:{name}"
+
+def update_label(update):
+    # labels come from registered handlers only, so user input can't inject frames
+    # (";") or blow up the number of roots in the flame graph
+    if update.callback_query and update.callback_query.data:
+        data = update.callback_query.data
+        for group in dispatcher.handlers.values():
+            for h in group:
+                if isinstance(h, CallbackQueryHandler) and h.pattern is not None and h.pattern.match(data):
+                    return "callback:" + data.split(":")[0]
+        return "callback:other"
+    msg = update.effective_message
+    if not msg: return "update"
+    if msg.text and msg.text.startswith("/"):
+        name = msg.text.split()[0][1:].split("@")[0].lower()
+        for group in dispatcher.handlers.values():
+            for h in group:
+                if isinstance(h, CommandHandler) and name in h.command:
+                    return "command:" + name
+        return "command:other"
+    if msg.photo or msg.video or msg.document: return "media"
+    return "text"
+
+class UpdateProfiler:
+    """Times every call made while one update is processed (sys.setprofile, current thread only).
+
+    Self time is charged to the full call stack in microseconds. Unlike a sampling thread this
+    also sees time spent inside C calls that hold the GIL (json encoding, socket reads), at the
+    cost of slowing the profiled update down noticeably.
+    """
+    def __init__(self, label):
+        self.label = label
+        self.weights = {}
+        self._stack = []
+        self._last = None
+
+    def _hook(self, frame, event, arg):
+        now = time.perf_counter()
+        if self._stack:
+            key = ";".join([self.label] + self._stack)
+            self.weights[key] = self.weights.get(key, 0.0) + (now - self._last)
+        if event == 'call':
+            self._stack.append(frame_label(frame))
+        elif event == 'c_call':
+            self._stack.append(c_func_label(arg))
+        elif self._stack:  # return / c_return / c_exception
+            self._stack.pop()
+        self._last = time.perf_counter()  # don't charge the hook's own overhead
+
+    def start(self):
+        sys.setprofile(self._hook)
+
+    def write(self):
+        logger = get_profile_logger()
+        for key, seconds in self.weights.items():
+            us = int(round(seconds * 1e6))
+            if us > 0: logger.info(f"{key} {us}")
+
+def process_update_sampled(update):
+    rate = profile_settings['rate']
+    if rate <= 0 or random.random() >= rate:
+        dispatcher.process_update(update); return
+    profiler = UpdateProfiler(update_label(update))
+    profiler.start()
+    try:
+        dispatcher.process_update(update)
+    finally:
+        sys.setprofile(None)  # called inline so no profiler frame gets charged
+        try: profiler.write()
+        except Exception: pass
+
 # token => {...}
 shared_files = {}
 
+# job_id => pending delivery (persisted, see run_delivery)
+delivery_outbox = {}
+
 # user_id => ephemeral state (not persisted)
 user_state = {}
 
@@ -76,6 +256,8 @@ MSG_ASK_PASSWORD_CHOICE = "🔐 এই লিঙ্কের জন্য পা
 MSG_LINK_READY = "✅ আপনার শেয়ার লিঙ্ক তৈরি হয়ে গেছে!\nএখন থেকে লিঙ্কে ক্লিক করলে নির্ধারিত মেয়াদের মধ্যে ফাইলগুলো পাওয়া যাবে।"
 MSG_LINK_EXPIRED = "❌ দুঃখিত, এই শেয়ার লিঙ্কটির মেয়াদ শেষ/বাতিল হয়েছে।"
 MSG_DELIVERY_NOTICE_TEMPLATE = "⚠️ মনে রাখবেন, এই ফাইলগুলো {HUMAN} পর স্বয়ংক্রিয়ভাবে মুছে যাবে।"
+MSG_DELIVERY_PARTIAL_TEMPLATE = "⚠️ দুঃখিত, {N}টি ব্যাচের ফাইল পাঠানো যায়নি (ফাইলগুলো আর পাওয়া যাচ্ছে না)।"
+MSG_DELIVERY_FAILED = "❌ দুঃখিত, কিছু ফাইল পাঠানো যায়নি। পরে আবার লিঙ্কে ক্লিক করে চেষ্টা করুন।"
 
 # ----------------------------
 # Time Presets
@@ -163,7 +345,7 @@ def make_password_hash(password: str, salt: str) -> str:
 # ----------------------------
 def start(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    all_users.add(user_id); save_state()
+    add_user(user_id); save_state()
     args = context.args
 
     if args:
@@ -174,7 +356,7 @@ def start(update: Update, context: CallbackContext):
         now = time.time()
         expiry = entry.get('link_expiry')
         if expiry is not None and now > expiry:
-            entry['revoked'] = True; save_state()
+            update_entry(token, revoked=True); save_state()
             context.bot.send_message(chat_id=user_id, text=MSG_LINK_EXPIRED); return
         if entry.get('password_hash'):
             locked_until = entry.get('locked_until')
@@ -194,34 +376,140 @@ def start(update: Update, context: CallbackContext):
         context.bot.send_message(chat_id=user_id, text=MSG_WELCOME)
 
 def deliver_token_payload(context: CallbackContext, user_id: int, token: str):
-    entry = shared_files.get(token)
+    with token_lock(token):
+        entry = shared_files.get(token)
+        if entry:
+            entry = update_entry(token, hit_count=entry.get('hit_count', 0) + 1, last_access=time.time())
     if not entry:
         context.bot.send_message(chat_id=user_id, text=MSG_LINK_EXPIRED); return
-    entry['hit_count'] = entry.get('hit_count', 0) + 1
-    entry['last_access'] = time.time(); save_state()
-
-    sent_message_ids = []
-    for batch in entry.get('media_batches', []):
-        media_group = []
-        for it in batch:
-            kind = it.get('kind')
-            if kind == 'photo':
-                media_group.append(InputMediaPhoto(it['file_id']))
-            elif kind == 'video':
-                media_group.append(InputMediaVideo(it['file_id']))
-            else:
-                media_group.append(InputMediaDocument(it['file_id'], filename=it.get('filename', os.path.basename(it['file_id']))))
-        if media_group:
-            msgs = context.bot.send_media_group(chat_id=user_id, media=media_group)
-            sent_message_ids.extend(m.message_id for m in msgs)
+    job_id = enqueue_delivery(user_id, token, entry)
+    save_state()
+    # first attempt inline; failed batches are retried by outbox_job
+    run_delivery(context, job_id)
+
+# ---- Delivery outbox ----
+OUTBOX_TICK = 5
+OUTBOX_MAX_ATTEMPTS = 8       # consecutive failures without progress
+OUTBOX_MAX_FLOOD_WAITS = 30   # consecutive RetryAfter without progress, counted separately
+OUTBOX_BACKOFF_BASE = 5
+OUTBOX_BACKOFF_MAX = 600
+_outbox_running = set()
+
+def build_media_group(batch):
+    media_group = []
+    for it in batch:
+        kind = it.get('kind')
+        if kind == 'photo':
+            media_group.append(InputMediaPhoto(it['file_id']))
+        elif kind == 'video':
+            media_group.append(InputMediaVideo(it['file_id']))
+        else:
+            media_group.append(InputMediaDocument(it['file_id'], filename=it.get('filename', os.path.basename(it['file_id']))))
+    return media_group
+
+def enqueue_delivery(chat_id: int, token: str, entry: dict) -> str:
+    job_id = uuid.uuid4().hex[:12]
+    job = {
+        'chat_id': chat_id,
+        'token': token,
+        'batches': entry.get('media_batches', []),
+        'delete_after': entry.get('delete_after'),
+        'next_batch': 0,
+        'sent_ids': [],
+        'notice_sent': False,
+        'skipped_batches': 0,
+        'attempts': 0,
+        'flood_waits': 0,
+        'next_try': 0,
+        'created_at': time.time(),
+    }
+    with STATE_LOCK:
+        delivery_outbox[job_id] = job
+    return job_id
+
+def update_outbox_job(job_id, **changes):
+    # copy-on-write, same as update_entry
+    with STATE_LOCK:
+        job = dict(delivery_outbox[job_id], **changes)
+        delivery_outbox[job_id] = job
+        return job
+
+def run_delivery(context: CallbackContext, job_id: str):
+    with STATE_LOCK:
+        job = delivery_outbox.get(job_id)
+        if job is None or job_id in _outbox_running: return
+        _outbox_running.add(job_id)
+    try:
+        entry = shared_files.get(job['token'])
+        if not entry or entry.get('revoked'):
+            # link revoked/cleaned up while waiting: stop sending, still delete what arrived
+            finish_delivery(context, job_id, job); return
+        _run_delivery(context, job_id, job)
+    finally:
+        with STATE_LOCK:
+            _outbox_running.discard(job_id)
+
+def _run_delivery(context: CallbackContext, job_id: str, job: dict):
+    # progress is kept in memory during an attempt and persisted by delivery_failed /
+    # finish_delivery; a crash mid-attempt resends from the last persisted batch
+    chat_id = job['chat_id']
+    try:
+        while job['next_batch'] < len(job['batches']):
+            media_group = build_media_group(job['batches'][job['next_batch']])
+            ids, skipped = [], 0
+            if media_group:
+                try:
+                    msgs = context.bot.send_media_group(chat_id=chat_id, media=media_group)
+                    ids = [m.message_id for m in msgs]
+                except BadRequest:
+                    skipped = 1  # e.g. stale file_id: skip this batch, keep delivering the rest
+            # progress resets the retry counters
+            job = update_outbox_job(job_id, next_batch=job['next_batch'] + 1, sent_ids=job['sent_ids'] + ids,
+                                    skipped_batches=job.get('skipped_batches', 0) + skipped,
+                                    attempts=0, flood_waits=0)
+        if not job['notice_sent']:
+            text = MSG_DELIVERY_NOTICE_TEMPLATE.format(HUMAN=human_readable(job['delete_after']))
+            if job.get('skipped_batches'):
+                text = MSG_DELIVERY_PARTIAL_TEMPLATE.format(N=job['skipped_batches']) + "\n" + text
+            notice = context.bot.send_message(chat_id=chat_id, text=text)
+            job = update_outbox_job(job_id, notice_sent=True, sent_ids=job['sent_ids'] + [notice.message_id])
+    except RetryAfter as e:
+        delivery_failed(context, job_id, job, delay=e.retry_after); return
+    except (BadRequest, Unauthorized):
+        # user blocked the bot / chat unusable: retrying won't help
+        delivery_failed(context, job_id, job, permanent=True); return
+    except Exception:
+        delivery_failed(context, job_id, job); return
+    finish_delivery(context, job_id, job)
+
+def delivery_failed(context: CallbackContext, job_id: str, job: dict, delay=None, permanent=False):
+    # delay is set for RetryAfter: Telegram's flood wait has its own cap and no backoff
+    attempts = job['attempts'] + (0 if delay is not None else 1)
+    flood_waits = job.get('flood_waits', 0) + (1 if delay is not None else 0)
+    if permanent or attempts >= OUTBOX_MAX_ATTEMPTS or flood_waits >= OUTBOX_MAX_FLOOD_WAITS:
+        try: context.bot.send_message(chat_id=job['chat_id'], text=MSG_DELIVERY_FAILED)
+        except Exception: pass
+        finish_delivery(context, job_id, job); return
+    if delay is None:
+        delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+    update_outbox_job(job_id, attempts=attempts, flood_waits=flood_waits, next_try=time.time() + delay)
+    save_state()
 
-    human = human_readable(entry.get('delete_after'))
-    notice = context.bot.send_message(chat_id=user_id, text=MSG_DELIVERY_NOTICE_TEMPLATE.format(HUMAN=human))
-    sent_message_ids.append(notice.message_id)
+def finish_delivery(context: CallbackContext, job_id: str, job: dict):
+    with STATE_LOCK:
+        delivery_outbox.pop(job_id, None)
+    save_state()
+    # only messages that actually arrived are scheduled for deletion
+    delete_after = job['delete_after']
+    if job['sent_ids'] and delete_after is not None and delete_after > 0:
+        threading.Thread(target=delete_messages_after, args=(context, job['chat_id'], job['sent_ids'], delete_after), daemon=True).start()
 
-    delete_after = entry.get('delete_after')
-    if delete_after is not None and delete_after > 0:
-        threading.Thread(target=delete_messages_after, args=(context, user_id, sent_message_ids, delete_after), daemon=True).start()
+def outbox_job(context: CallbackContext):
+    now = time.time()
+    with STATE_LOCK:
+        due = [job_id for job_id, job in delivery_outbox.items() if job['next_try'] <= now]
+    for job_id in due:
+        run_delivery(context, job_id)
 
 def delete_messages_after(context: CallbackContext, chat_id: int, message_ids, delay_seconds: int):
     if delay_seconds > 60:
@@ -244,10 +532,12 @@ def forward_to_admins(msg, ctx):
     if user_id in SUPER_ADMINS: return
     if msg.media_group_id:
         gid = msg.media_group_id
-        pending_groups.setdefault(gid, []).append(msg)
+        with STATE_LOCK:
+            pending_groups.setdefault(gid, []).append(msg)
         def flush_group():
             time.sleep(1.5)
-            messages = pending_groups.pop(gid, [])
+            with STATE_LOCK:
+                messages = pending_groups.pop(gid, [])
             if not messages: return
             media = []
             for m in messages:
@@ -353,15 +643,13 @@ def on_password_choice(update: Update, context: CallbackContext):
         finalize_token_creation(user_id, context, password_text=None)
     query.answer()
 
-def finalize_token_creation(user_id: int, context: CallbackContext, password_text: str = None):
-    ensure_user_state(user_id)
-    media_items = user_state[user_id].get('pending_media_items') or []
-    if not media_items:
-        context.bot.send_message(chat_id=user_id, text="❌ কোনো ফাইল পাওয়া যায়নি।"); return
+def new_token():
+    # caller must hold STATE_LOCK and insert the token before releasing it
+    while True:
+        token = str(uuid.uuid4())[:8]
+        if token not in shared_files: return token
 
-    media_batches = list(chunked(media_items, 10))
-    token = str(uuid.uuid4())[:8]
-    link_expiry_seconds = user_state[user_id]['link_expiry']
+def build_token_entry(owner_id, media_items, link_expiry_seconds, delete_after, password_text=None):
     link_expiry_epoch = None if link_expiry_seconds is None else time.time() + link_expiry_seconds
 
     password_hash = None
@@ -370,12 +658,12 @@ def finalize_token_creation(user_id: int, context: CallbackContext, password_tex
         password_salt = secrets.token_hex(8)
         password_hash = make_password_hash(password_text, password_salt)
 
-    shared_files[token] = {
-        'media_batches': media_batches,
+    return {
+        'media_batches': list(chunked(media_items, 10)),
         'link_expiry': link_expiry_epoch,
-        'delete_after': user_state[user_id]['delete_after'],
+        'delete_after': delete_after,
         'created_at': time.time(),
-        'owner_id': user_id,
+        'owner_id': owner_id,
         'hit_count': 0,
         'last_access': None,
         'revoked': False,
@@ -384,6 +672,18 @@ def finalize_token_creation(user_id: int, context: CallbackContext, password_tex
         'locked_until': None,
         'password_attempts': 0,
     }
+
+def finalize_token_creation(user_id: int, context: CallbackContext, password_text: str = None):
+    ensure_user_state(user_id)
+    media_items = user_state[user_id].get('pending_media_items') or []
+    if not media_items:
+        context.bot.send_message(chat_id=user_id, text="❌ কোনো ফাইল পাওয়া যায়নি।"); return
+
+    link_expiry_seconds = user_state[user_id]['link_expiry']
+    entry = build_token_entry(user_id, media_items, link_expiry_seconds, user_state[user_id]['delete_after'], password_text)
+    with STATE_LOCK:
+        token = new_token()
+        shared_files[token] = entry
     save_state()
 
     # reset temp state
@@ -404,7 +704,7 @@ def finalize_token_creation(user_id: int, context: CallbackContext, password_tex
         caption=(
             f"🔗 শেয়ার লিঙ্ক: {link}\n"
             f"⏳ লিঙ্কের মেয়াদ: {human_readable(link_expiry_seconds)}\n"
-            f"🧹 ডেলিভারির পর মুছবে: {human_readable(shared_files[token]['delete_after'])}"
+            f"🧹 ডেলিভারির পর মুছবে: {human_readable(entry['delete_after'])}"
             + ("" if not password_text else "\n🔐 পাসকোড: সেট করা আছে")
         )
     )
@@ -435,14 +735,33 @@ def handle_text(update: Update, context: CallbackContext):
         salt = entry.get('password_salt')
         hashed = make_password_hash(text, salt) if salt else None
         if hashed and hashed == entry.get('password_hash'):
-            entry['password_attempts'] = 0; entry['locked_until'] = None
+            # re-check and reset under the token lock so a concurrent wrong attempt isn't lost
+            with token_lock(waiting_token):
+                entry = shared_files.get(waiting_token)
+                locked_until = entry.get('locked_until') if entry else None
+                if entry and not entry.get('revoked') and not (locked_until and now < locked_until):
+                    entry = update_entry(waiting_token, password_attempts=0, locked_until=None)
+            if not entry or entry.get('revoked'):
+                update.message.reply_text(MSG_LINK_EXPIRED)
+                user_state[user_id]['awaiting_password_for_token'] = None; return
+            if locked_until and now < locked_until:
+                wait_s = int(locked_until - now)
+                update.message.reply_text(f"🔒 ভুল কোড বেশি বার দেয়া হয়েছে। {wait_s} সেকেন্ড পর আবার চেষ্টা করুন।"); return
             user_state[user_id]['awaiting_password_for_token'] = None
             save_state()
             deliver_token_payload(context, user_id, waiting_token)
         else:
-            entry['password_attempts'] = entry.get('password_attempts', 0) + 1
+            with token_lock(waiting_token):
+                entry = shared_files.get(waiting_token)
+                if entry:
+                    attempts = entry.get('password_attempts', 0) + 1
+                    changes = {'password_attempts': attempts}
+                    if attempts >= 5: changes['locked_until'] = now + 15 * 60
+                    entry = update_entry(waiting_token, **changes)
+            if not entry:
+                update.message.reply_text(MSG_LINK_EXPIRED)
+                user_state[user_id]['awaiting_password_for_token'] = None; return
             if entry['password_attempts'] >= 5:
-                entry['locked_until'] = now + 15 * 60
                 update.message.reply_text("❌ ভুল কোড। অনেকবার ভুল হয়েছে, ১৫ মিনিট পর চেষ্টা করুন।")
             else:
                 left = 5 - entry['password_attempts']
@@ -471,7 +790,7 @@ def build_links_pages(context: CallbackContext, user_id: int):
 
     if is_admin:
         by_owner = {}
-        for token, entry in shared_files.items():
+        for token, entry in entries_snapshot():
             by_owner.setdefault(entry.get('owner_id'), []).append((token, entry))
         if not by_owner: return ["(কোনো লিঙ্ক নেই)"]
         for owner in sorted(by_owner.keys(), key=lambda x: str(x)):
@@ -488,7 +807,7 @@ def build_links_pages(context: CallbackContext, user_id: int):
             buf += block + "\n"
         if buf: pages.append(buf.strip())
     else:
-        own_items = [(t, e) for t, e in shared_files.items() if e.get('owner_id') == user_id]
+        own_items = [(t, e) for t, e in entries_snapshot() if e.get('owner_id') == user_id]
         if not own_items: return ["(কোনো লিঙ্ক নেই)"]
         for token, entry in own_items:
             block = card_line(token, entry) + "\n"
@@ -523,9 +842,9 @@ def handle_links(update: Update, context: CallbackContext):
     MAX_BUTTONS = 30
     tokens_for_buttons = []
     if user_id in SUPER_ADMINS:
-        tokens_for_buttons = list(shared_files.keys())
+        tokens_for_buttons = [token for token, _ in entries_snapshot()]
     else:
-        for token, entry in shared_files.items():
+        for token, entry in entries_snapshot():
             if entry.get('owner_id') == user_id:
                 tokens_for_buttons.append(token)
 
@@ -577,7 +896,7 @@ def handle_revoke_cmd(update: Update, context: CallbackContext):
         update.message.reply_text("টোকেন পাওয়া যায়নি।"); return
     if (not is_admin) and entry.get('owner_id') != user_id:
         update.message.reply_text("আপনার অনুমতি নেই।"); return
-    entry['revoked'] = True; save_state()
+    update_entry(token, revoked=True); save_state()
     update.message.reply_text(f"✅ টোকেন {token} রেভোক করা হয়েছে।")
 
 def on_revoke_callback(update: Update, context: CallbackContext):
@@ -589,7 +908,7 @@ def on_revoke_callback(update: Update, context: CallbackContext):
     if not entry: query.answer("পাওয়া যায়নি", show_alert=True); return
     if (not is_admin) and entry.get('owner_id') != user_id:
         query.answer("অনুমতি নেই", show_alert=True); return
-    entry['revoked'] = True; save_state()
+    update_entry(token, revoked=True); save_state()
     query.answer("রেভোক হয়েছে")
     try: context.bot.edit_message_reply_markup(chat_id=query.message.chat_id, message_id=query.message.message_id, reply_markup=None)
     except Exception: pass
@@ -598,21 +917,38 @@ def on_revoke_callback(update: Update, context: CallbackContext):
 def cleanup_expired(context: CallbackContext):
     now = time.time()
     to_delete = []
-    for token, entry in list(shared_files.items()):
+    for token, entry in entries_snapshot():
         exp = entry.get('link_expiry')
         revoked = entry.get('revoked')
         if exp is not None and now > exp + 7*DAY:
             to_delete.append(token)
         elif revoked and (now - entry.get('created_at', now) > 30*DAY):
             to_delete.append(token)
-    for t in to_delete:
-        try: shared_files.pop(t, None)
-        except Exception: pass
+    with STATE_LOCK:
+        for t in to_delete:
+            shared_files.pop(t, None)
     if to_delete: save_state()
 
 def autosave_job(context: CallbackContext):
     save_state()
 
+def handle_profile(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    if user_id not in SUPER_ADMINS:
+        update.message.reply_text("❌ ক্ষমা প্রার্থনা, আপনি অনুমোদিত সুপার এডমিন নন।"); return
+    if context.args:
+        arg = context.args[0].lower()
+        try:
+            rate = 0.0 if arg == "off" else float(arg)
+        except ValueError:
+            rate = -1
+        if not 0 <= rate <= 1:
+            update.message.reply_text("ব্যবহার: /profile <0-1 | off>"); return
+        profile_settings['rate'] = rate
+    rate = profile_settings['rate']
+    status = "off" if rate <= 0 else f"{rate:g} of updates"
+    update.message.reply_text(f"📈 Profiling: {status}\nOutput: {PROFILE_FILE}")
+
 # =========================
 # Flask + Webhook wiring
 # =========================
@@ -624,19 +960,20 @@ bot = Bot(TOKEN)
 
 # Dispatcher (without Updater)
 dispatcher = Dispatcher(bot, update_queue=None, workers=0, use_context=True)
-# Register handlers (same set as polling version)
-dispatcher.add_handler(CommandHandler("start", start))
+# Register handlers (same set as polling version); user_state handlers are serialized per user
+dispatcher.add_handler(CommandHandler("start", per_user_locked(start)))
 dispatcher.add_handler(CommandHandler("msg", handle_msg))
 dispatcher.add_handler(CommandHandler("user", handle_user_list))
-dispatcher.add_handler(CommandHandler("links", handle_links))
+dispatcher.add_handler(CommandHandler("links", per_user_locked(handle_links)))
 dispatcher.add_handler(CommandHandler("revoke", handle_revoke_cmd))
-dispatcher.add_handler(MessageHandler(Filters.document | Filters.photo | Filters.video, handle_media))
-dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_text))
-dispatcher.add_handler(CallbackQueryHandler(on_link_expiry_selected, pattern=r"^linkexp:"))
-dispatcher.add_handler(CallbackQueryHandler(on_delete_after_selected, pattern=r"^delafter:"))
-dispatcher.add_handler(CallbackQueryHandler(on_password_choice, pattern=r"^pwdchoice:"))
+dispatcher.add_handler(CommandHandler("profile", handle_profile))
+dispatcher.add_handler(MessageHandler(Filters.document | Filters.photo | Filters.video, per_user_locked(handle_media)))
+dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, per_user_locked(handle_text)))
+dispatcher.add_handler(CallbackQueryHandler(per_user_locked(on_link_expiry_selected), pattern=r"^linkexp:"))
+dispatcher.add_handler(CallbackQueryHandler(per_user_locked(on_delete_after_selected), pattern=r"^delafter:"))
+dispatcher.add_handler(CallbackQueryHandler(per_user_locked(on_password_choice), pattern=r"^pwdchoice:"))
 dispatcher.add_handler(CallbackQueryHandler(on_revoke_callback, pattern=r"^revoke:"))
-dispatcher.add_handler(CallbackQueryHandler(on_links_nav, pattern=r"^linksnav:"))
+dispatcher.add_handler(CallbackQueryHandler(per_user_locked(on_links_nav), pattern=r"^linksnav:"))
 
 # JobQueue (manually start)
 job_queue = JobQueue()
@@ -644,6 +981,7 @@ job_queue.set_dispatcher(dispatcher)
 job_queue.start()
 job_queue.run_repeating(cleanup_expired, interval=3600, first=60)
 job_queue.run_repeating(autosave_job,   interval=120,  first=30)
+job_queue.run_repeating(outbox_job,     interval=OUTBOX_TICK, first=10)
 
 # Load persisted state before serving
 load_state()
@@ -658,9 +996,97 @@ def health():
 @app.route(f"/{TOKEN}", methods=["POST"])
 def webhook():
     update = Update.de_json(request.get_json(force=True), bot)
-    dispatcher.process_update(update)
+    process_update_sampled(update)
     return "OK", 200
 
+# ---- Bulk link creation API ----
+# POST /api/links with header "Authorization: Bearer <API_KEY>"
+# {"owner_id": 123, "links": [{"files": [{"kind": "photo|video|document", "file_id": "...", "filename": "..."}],
+#   "link_expiry": 3600|null, "delete_after": 600|null, "passcode": "1234"|null}]}
+API_KEY = os.environ.get("API_KEY")
+BULK_MAX_LINKS = 500
+BULK_MAX_FILES = 100
+
+def parse_duration(value):
+    if value is None: return None
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 < value <= YEARS_5:
+        raise ValueError(f"must be 1-{YEARS_5} seconds or null")
+    return value
+
+def parse_link_spec(spec):
+    if not isinstance(spec, dict): raise ValueError("must be an object")
+    files = spec.get('files')
+    if not isinstance(files, list) or not 1 <= len(files) <= BULK_MAX_FILES:
+        raise ValueError(f"files must be a list of 1-{BULK_MAX_FILES} files")
+    media_items = []
+    for it in files:
+        if not isinstance(it, dict) or not isinstance(it.get('file_id'), str) or not it['file_id']:
+            raise ValueError("each file needs a file_id")
+        kind = it.get('kind', 'document')
+        if kind == 'document':
+            media_items.append({'kind': 'document', 'file_id': it['file_id'], 'filename': str(it.get('filename') or "file")})
+        elif kind in ('photo', 'video'):
+            media_items.append({'kind': kind, 'file_id': it['file_id']})
+        else:
+            raise ValueError(f"unknown kind: {kind}")
+    passcode = spec.get('passcode')
+    if passcode is not None and (not isinstance(passcode, str) or not 4 <= len(passcode) <= 64):
+        raise ValueError("passcode must be 4-64 characters")
+    try:
+        link_expiry = parse_duration(spec.get('link_expiry'))
+    except ValueError as e:
+        raise ValueError(f"link_expiry {e}")
+    try:
+        delete_after = parse_duration(spec.get('delete_after'))
+    except ValueError as e:
+        raise ValueError(f"delete_after {e}")
+    return media_items, link_expiry, delete_after, passcode
+
+@app.route("/api/links", methods=["POST"])
+def api_create_links():
+    auth = request.headers.get("Authorization", "")
+    if not API_KEY or not secrets.compare_digest(auth.encode("utf-8"), f"Bearer {API_KEY}".encode("utf-8")):
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"ok": False, "error": "body must be an object"}), 400
+    owner_id = body.get('owner_id')
+    specs = body.get('links')
+    if isinstance(owner_id, bool) or not isinstance(owner_id, int):
+        return jsonify({"ok": False, "error": "owner_id must be an integer"}), 400
+    if not isinstance(specs, list) or not specs or len(specs) > BULK_MAX_LINKS:
+        return jsonify({"ok": False, "error": f"links must be a list of 1-{BULK_MAX_LINKS} specs"}), 400
+
+    # validate everything first so a bad spec never leaves a half-created batch
+    parsed = []
+    for i, spec in enumerate(specs):
+        try:
+            parsed.append(parse_link_spec(spec))
+        except ValueError as e:
+            return jsonify({"ok": False, "error": f"links[{i}]: {e}"}), 400
+
+    # username may need a get_me() round-trip; fetch it before anything is stored
+    try:
+        bot_username = bot.username
+    except Exception:
+        return jsonify({"ok": False, "error": "telegram unavailable"}), 503
+
+    entries = [build_token_entry(owner_id, media_items, link_expiry, delete_after, passcode)
+               for media_items, link_expiry, delete_after, passcode in parsed]
+    created = []
+    with STATE_LOCK:
+        for entry in entries:
+            token = new_token()
+            shared_files[token] = entry
+            created.append((token, entry))
+    save_state()
+
+    return jsonify({"ok": True, "links": [
+        {"token": token, "link": f"https://t.me/{bot_username}?start={token}",
+         "link_expiry": entry['link_expiry'], "delete_after": entry['delete_after']}
+        for token, entry in created
+    ]}), 200
+
 # Optional: helper to set webhook from code (use WEBHOOK_URL env)
 @app.before_first_request
 def init_webhook():
@@ -681,7 +1107,7 @@ def handle_msg(update: Update, context: CallbackContext):
     if not msg_text and not (message.photo or message.video or message.document):
         update.message.reply_text("❌ দয়া করে /msg এর সাথে কিছু লিখুন অথবা মিডিয়া যোগ করুন।"); return
     send_text = f"এডমিন মেসেজ: {msg_text}" if msg_text else None
-    for uid in list(all_users):
+    for uid in users_snapshot():
         if uid == user_id: continue
         try:
             if message.photo:
@@ -700,9 +1126,10 @@ def handle_user_list(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     if user_id not in SUPER_ADMINS:
         update.message.reply_text("❌ ক্ষমা প্রার্থনা, আপনি অনুমোদিত সুপার এডমিন নন।"); return
-    total_users = len(all_users)
+    users = users_snapshot()
+    total_users = len(users)
     user_lines = []
-    for uid in all_users:
+    for uid in users:
         try:
             user_obj = context.bot.get_chat(uid)
             uname = user_obj.username